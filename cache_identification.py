@@ -4,6 +4,16 @@ __author__ = "Matteo Golinelli"
 __copyright__ = "Copyright (C) 2023 Matteo Golinelli"
 __license__ = "MIT"
 
+# The C-level hot path of identify relies on the
+# pyahocorasick extension; fall back to a pure-Python
+# keyword scan where the extension is not available
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+import functools
+
 
 class CacheIdentification:
     '''
@@ -139,21 +149,93 @@ class CacheIdentification:
     }
 
     def __init__(self):
-        pass
+        self._deny_names  = frozenset(name.lower() for name in self.DENYLIST['name'])
+        self._deny_values = frozenset(self.DENYLIST['value'])
 
-    def identify(self, headers):
-        providers = []
+        if ahocorasick is not None:
+            self._name_ac  = self._build_automaton('name')
+            self._value_ac = self._build_automaton('value')
+        else:
+            self._name_ac = self._value_ac = None
+            self._lower_keywords = {
+                provider: {
+                    'name':  [keyword.lower() for keyword in keywords['name']],
+                    'value': [keyword.lower() for keyword in keywords['value']],
+                }
+                for provider, keywords in self.KEYWORDS.items()
+            }
+
+        # The name keywords all match at the start of a header
+        # name, so a single startswith() pass over the names is
+        # enough to tell whether the name scan can be skipped
+        self._name_indicators = tuple(
+            keyword.lower()
+            for keywords in self.KEYWORDS.values()
+            for keyword in keywords['name'])
+
+    def _build_automaton(self, field):
+        '''
+        Build an Aho-Corasick automaton over the
+        lowercase keywords of the given field
+        ('name' or 'value') of all the providers.
+        Each keyword is tagged with its provider so
+        that a single pass over a header returns
+        every matching provider.
+        '''
+        automaton = ahocorasick.Automaton()
+        for provider, keywords in self.KEYWORDS.items():
+            for keyword in keywords[field]:
+                automaton.add_word(keyword.lower(), provider)
+        automaton.make_automaton()
+        return automaton
 
+    def identify(self, headers):
+        items = []
         for name, value in headers.items():
-            if name in self.DENYLIST['name']:
+            name_l = name.lower()
+            if name_l in self._deny_names:
                 continue
-            if value in self.DENYLIST['value']:
+            if value in self._deny_values:
                 continue
+            items.append((name_l, value.lower()))
+
+        return list(self._identify_cached(tuple(sorted(items))))
+
+    @functools.lru_cache(maxsize=4096)
+    def _identify_cached(self, items):
+        '''
+        Identify the providers for a sorted tuple of
+        lowercase (name, value) header pairs.
+        Many responses share the same header signature
+        (e.g., CDN defaults), so the result is memoized
+        on the signature to skip repeated scans.
+        '''
+        providers = set()
+
+        # Fast pre-filter: if no header name starts with a known
+        # indicator, only the values need to be scanned
+        scan_names = any(
+            name_l.startswith(self._name_indicators) for name_l, _ in items)
+
+        num_providers = len(self.KEYWORDS)
+        for name_l, value_l in items:
+            # Every provider already matched: nothing left to find
+            if len(providers) == num_providers:
+                break
 
-            for provider, keywords in self.KEYWORDS.items():
-                if any(keyword.lower() in name.lower() for keyword in keywords['name']):
-                    providers.append(provider)
-                if any(keyword.lower() in value.lower() for keyword in keywords['value']):
-                    providers.append(provider)
+            if self._name_ac is not None:
+                if scan_names:
+                    providers.update(provider for _, provider in self._name_ac.iter(name_l))
+                providers.update(provider for _, provider in self._value_ac.iter(value_l))
+            else:
+                for provider, keywords in self._lower_keywords.items():
+                    if provider in providers:
+                        continue
+                    if (scan_names and
+                            any(keyword in name_l for keyword in keywords['name'])):
+                        providers.add(provider)
+                    elif any(keyword in value_l for keyword in keywords['value']):
+                        providers.add(provider)
 
-        return list(set(providers))
+        # Sorted for deterministic output (and stable cached results)
+        return tuple(sorted(providers))
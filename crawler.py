@@ -7,12 +7,15 @@ __license__ = "MIT"
 from requests.exceptions import SSLError, ConnectionError, ReadTimeout, TooManyRedirects, ChunkedEncodingError, InvalidHeader
 from urllib3.exceptions import NewConnectionError, MaxRetryError, ReadTimeoutError
 from urllib.parse import urlparse, urlunparse, urljoin, urldefrag
+from functools import lru_cache
 from bs4 import BeautifulSoup
 
+import collections
 import traceback
 import argparse
 import requests
 import urllib3
+import httpx
 import random
 import string
 import glob
@@ -22,6 +25,11 @@ import sys
 import os
 import re
 
+# The same URL is parsed several times while it moves through
+# queueing, deduplication and domain checks; urlparse is
+# comparatively expensive, so memoize the parsed results
+_urlparse = lru_cache(maxsize=8192)(urlparse)
+
 class Browser:
     """
     This class implements the methods to
@@ -110,21 +118,110 @@ class Browser:
         """
         return self.session.cookies.get_dict()
 
+class AsyncBrowser:
+    """
+    Asynchronous counterpart of the Browser class,
+    backed by httpx.AsyncClient so that multiple
+    URLs can be requested concurrently.
+
+    It defines the following methods:
+    - `get`: perform a GET request
+    """
+    def __init__(self, cookies=None, headers=None, verify=False, timeout=None):
+        """Constructor.
+
+        :param list cookies: the cookies to use
+        in the session. It is a list of dictionaries
+        that represent the cookies. Each dictionary
+        must have the following keys: name, value. The
+        other keys are optional and are: domain, path.
+
+        :param dict headers: the headers to use
+        in the session.
+
+        :param timeout: the default timeout (in seconds)
+        for all the requests of the session.
+        """
+        self.verify = verify
+        if not self.verify:
+            urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+        cookie_jar = httpx.Cookies()
+        if cookies:
+            for cookie in cookies:
+                cookie_jar.set(
+                    cookie['name'],
+                    cookie['value'],
+                    domain=(cookie['domain'] if 'domain' in cookie else ''),
+                    path=(cookie['path'] if 'path' in cookie else '/'),
+                )
+
+        self.session = httpx.AsyncClient(
+            headers=headers,
+            cookies=cookie_jar,
+            verify=verify,
+            timeout=timeout,
+        )
+
+    async def get(self, url, **kwargs):
+        """
+        Perform a GET request.
+
+        :param str url: the URL to request
+        """
+        if 'referrer' in kwargs:
+            self.session.headers.update({'Referer': kwargs['referrer']})
+        else:
+            self.session.headers.pop('Referer', None)
+        kwargs.pop('referrer', None)
+
+        # Follow redirects by default, like requests does
+        if 'allow_redirects' in kwargs:
+            kwargs['follow_redirects'] = kwargs.pop('allow_redirects')
+        else:
+            kwargs.setdefault('follow_redirects', True)
+
+        # httpx deprecated per-request cookies on the request
+        # methods; build the request explicitly instead, which
+        # still merges them with the session cookies
+        if 'cookies' in kwargs:
+            follow_redirects = kwargs.pop('follow_redirects')
+            request = self.session.build_request('GET', url, **kwargs)
+            return await self.session.send(request, follow_redirects=follow_redirects)
+
+        return await self.session.get(url, **kwargs)
+
+    async def close(self):
+        """
+        Close the underlying session.
+        """
+        await self.session.aclose()
+
+    def get_cookies(self):
+        """
+        Return the cookies of the session.
+
+        :return: the cookies of the session.
+        """
+        return dict(self.session.cookies)
+
 class Crawler:
     """
     This class implements the methods to
     crawl a website and extract the links
     present in the HTML pages.
     """
-    # Avoid accessing potentially large files
-    EXCLUDED_EXTENSIONS = set([
+    # Avoid accessing potentially large files.
+    # Kept as a tuple so the whole check is a
+    # single str.endswith() call.
+    EXCLUDED_EXTENSIONS = (
         '.webm', '.m3u', '.m3u8', '.pls', '.cue', '.wpl', '.asx', '.xspf', '.mpd'
         '.ps', '.tif', '.tiff', '.ppt', '.pptx', '.xls', '.xlsx', '.dll', '.msi',
         '.iso', '.sql', '.apk', '.jar', '.bmp', '.gif', '.jpg', '.jpeg', '.png',
         '.zip', '.exe', '.dmg', '.doc', '.docx', '.odt', '.pdf', '.rtf', '.tex',
         '.mpg', '.mpeg', '.avi', '.mov', '.wmv', '.flv', '.swf', '.mp4', '.m4v',
         '.mp3', '.ogg', '.wav', '.wma', '.7z', '.rpm', '.gz', '.tar', '.deb',
-    ])
+    )
 
     # Default maximum number of URLs to visit for each domain
     MAX   = 50
@@ -140,8 +237,16 @@ class Crawler:
         :param int max_domains: the maximum number of subdomains to crawl
         """
         self.site = site
+        # domain -> deque of URLs to visit, with a companion
+        # set of the queued URLs for O(1) membership tests
         self.queue = {}
+        self._queued = set()
+        # domain -> set of visited template URLs
         self.visited_urls = {}
+        # Templates claimed by a worker whose test is still
+        # running: URLs with these templates stay queued until
+        # the outcome of that test is known
+        self.in_flight = set()
         self.max = max
         self.max_domains = max_domains
 
@@ -164,7 +269,7 @@ class Crawler:
         :param str url: the URL to parse.
         :return: the template of the URL.
         """
-        parsed = urlparse(url)
+        parsed = _urlparse(url)
         return urlunparse(('', parsed.netloc, re.sub('\d+', '', parsed.path), '', '', ''))
 
     def get_domain(self, url):
@@ -173,7 +278,7 @@ class Crawler:
 
         :param str url: the URL to parse.
         """
-        return urlparse(url).netloc
+        return _urlparse(url).netloc
 
     def is_internal_url(self, url):
         """
@@ -185,7 +290,7 @@ class Crawler:
         """
         if not url.startswith('http'):
             url = 'http://' + url
-        parsed = urlparse(url)
+        parsed = _urlparse(url)
         if parsed.netloc.endswith(self.site):
             return True
         else:
@@ -230,16 +335,19 @@ class Crawler:
 
         :param str url: the URL to add.
         """
+        if url in self._queued:
+            return
+
         domain = self.get_domain(url)
 
         if not self.is_visited(url):
             if domain not in self.queue and \
                 len(self.queue) < self.max_domains:
-                self.queue[domain] = []
+                self.queue[domain] = collections.deque()
 
-            if domain in self.queue and \
-                url not in self.queue[domain]:
+            if domain in self.queue:
                 self.queue[domain].append(url)
+                self._queued.add(url)
 
     def add_to_visited(self, url):
         """
@@ -250,10 +358,22 @@ class Crawler:
         if not self.is_visited(url):
             domain  = self.get_domain(url)
             if domain not in self.visited_urls:
-                self.visited_urls[domain] = []
+                self.visited_urls[domain] = set()
 
             template_url = self.get_template_url(url)
-            self.visited_urls[domain].append(template_url)
+            self.visited_urls[domain].add(template_url)
+
+    def remove_from_visited(self, url):
+        """
+        Remove a url from the visited list, e.g. when
+        its request failed and another URL with the
+        same template should still be attempted.
+
+        :param str url: the URL to remove.
+        """
+        domain = self.get_domain(url)
+        if domain in self.visited_urls:
+            self.visited_urls[domain].discard(self.get_template_url(url))
 
     def is_visited(self, url):
         """
@@ -295,11 +415,19 @@ class Crawler:
                 # Pop the first url in the queue
                 # for this domain
                 while len(self.queue[domain]) > 0:
-                    url = self.queue[domain].pop(0)
+                    url = self.queue[domain].popleft()
                     if not self.is_visited(url):
+                        self._queued.discard(url)
                         if add_to_visited:
                             self.add_to_visited(url)
                         return url
+                    if self.get_template_url(url) in self.in_flight:
+                        # The template was claimed by a worker whose
+                        # test is still running: keep the url queued
+                        # so that it can be retried if the test fails
+                        self.queue[domain].append(url)
+                        break
+                    self._queued.discard(url)
         return None
 
     def should_continue(self):
@@ -326,7 +454,9 @@ class Crawler:
 
         :param dict visited_urls: the visited URLs.
         """
-        self.visited_urls = visited_urls
+        self.visited_urls = {
+            domain: set(urls) for domain, urls in visited_urls.items()
+        }
 
     def set_queue(self, queue):
         """
@@ -334,4 +464,7 @@ class Crawler:
 
         :param dict queue: the queue.
         """
-        self.queue = queue
+        self.queue = {
+            domain: collections.deque(urls) for domain, urls in queue.items()
+        }
+        self._queued = set(url for urls in self.queue.values() for url in urls)
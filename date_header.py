@@ -4,20 +4,14 @@ __author__ = "Matteo Golinelli"
 __copyright__ = "Copyright (C) 2023 Matteo Golinelli"
 __license__ = "MIT"
 
-from crawler import Browser, Crawler
-from cache_buster import CacheBuster
-from cache_identification import CacheIdentification
-from wcde import WCDE
-
-from requests.exceptions import SSLError, ConnectionError, ReadTimeout, TooManyRedirects, ChunkedEncodingError, InvalidHeader
 from urllib.parse import urlparse
 
-import traceback
 import argparse
+import asyncio
 import logging
 import random
+import orjson
 import json
-import time
 import sys
 import os
 import re
@@ -35,27 +29,29 @@ class bcolors:
 
 TIMEOUT = 30
 
+# Number of URLs tested concurrently
+CONCURRENCY = 16
+
 statistics = {}
-network = {}
 
 
 def save_dictionaries(site, crawler):
     """
     Save the dictionaries to files.
+    The network entries are streamed to the NDJSON
+    file while crawling, so they need no saving here.
     """
-    global statistics, network
+    global statistics
 
     logs = {
-        'queue':   crawler.queue,
-        'visited': crawler.visited_urls
+        'queue':   {domain: list(urls) for domain, urls in crawler.queue.items()},
+        'visited': {domain: list(urls) for domain, urls in crawler.visited_urls.items()}
     }
 
-    with open(f'logs/{site}-logs.json', 'w') as f:
-        json.dump(logs, f, indent=4)
-    with open(f'stats/{site}-stats.json', 'w') as f:
-        json.dump(statistics, f, indent=4)
-    with open(f'network/{site}-network.json', 'w') as f:
-        json.dump(network, f, indent=4)
+    with open(f'logs/{site}-logs.json', 'wb') as f:
+        f.write(orjson.dumps(logs, option=orjson.OPT_INDENT_2))
+    with open(f'stats/{site}-stats.json', 'wb') as f:
+        f.write(orjson.dumps(statistics, option=orjson.OPT_INDENT_2))
 
 def get_dictionaries(site, crawler):
     """
@@ -89,7 +85,7 @@ def get_dictionaries(site, crawler):
 # =============================================================================
 
 def main():
-    global site, statistics, network
+    global site, statistics
 
     logging.basicConfig()
 
@@ -130,6 +126,17 @@ def main():
         help='Use a seed for the random number generator to make the results reproducible')
 
     args = parser.parse_args()
+
+    # Deferred imports: these drag in requests, bs4 and httpx,
+    # so importing after argument parsing keeps the startup of
+    # short runs (and --help) fast
+    import httpx
+
+    from crawler import AsyncBrowser, Crawler
+    from cache_buster import CacheBuster
+    from cache_identification import CacheIdentification
+    from wcde import WCDE
+
     wcde = WCDE()
 
     if args.target:
@@ -209,110 +216,147 @@ def main():
     if args.cookie:
         logger.info('Using provided cookies to create the victim\'s session.')
 
-    browser = Browser(headers=headers, cookies=cookies)
+    browser = AsyncBrowser(headers=headers, cookies=cookies, timeout=TIMEOUT)
     cache_buster = CacheBuster(site=SITE, headers=headers, cookies=cookies)
     cache_identification = CacheIdentification()
 
-    while crawler.should_continue():
+    # Compile the exclusion regexes once into a single alternation
+    if args.exclude:
+        exclude_re = re.compile('|'.join(
+            f'(?:{regex.strip()})' for regex in args.exclude.split(',') if regex.strip()))
+    else:
+        exclude_re = None
+
+    # Bind the methods used on every URL to locals once,
+    # so the workers skip the attribute lookups on each call
+    browser_get              = browser.get
+    get_links                = crawler.get_links
+    add_to_queue             = crawler.add_to_queue
+    add_to_visited           = crawler.add_to_visited
+    remove_from_visited      = crawler.remove_from_visited
+    get_template_url         = crawler.get_template_url
+    get_url_from_queue       = crawler.get_url_from_queue
+    excluded_extensions      = crawler.EXCLUDED_EXTENSIONS
+    identify                 = cache_identification.identify
+    cache_bust_request       = cache_buster.cache_bust_request
+    cache_headers_heuristics = wcde.cache_headers_heuristics
+    log_info                 = logger.info
+    log_error                = logger.error
+
+    # Stream each URL's network entry as one NDJSON line,
+    # so the crawl uses constant memory and partial results
+    # survive crashes and interruptions
+    network_file = open(f'network/{SITE}-network.ndjson', 'ab')
+
+    stop = asyncio.Event()
+    active = 0
+
+    async def test_url(url):
+        log_info('Visiting URL: %s', url)
+
+        # Request the URL
         try:
-            url = crawler.get_url_from_queue()
-
-            if url is None:
-                break
-
-            if crawler.is_visited(url):
-                continue
-
-            if args.exclude:
-                if any(re.search(regex.strip(), url) for regex in args.exclude.split(',')):
-                    continue
-
-            parsed = urlparse(url)
-            if any(parsed.path.endswith(ext) for ext in crawler.EXCLUDED_EXTENSIONS):
-                continue
-
-            logger.info(f'Visiting URL: {url}')
-
-            # Request the URL
-            try:
-                response = browser.get(url, allow_redirects=True, timeout=TIMEOUT)
-            except (SSLError, ConnectionError, ReadTimeout, TooManyRedirects, ChunkedEncodingError, InvalidHeader) as e:
-                logger.error(f'ERROR: {url} -> {e}')
-                if not 'errors' in statistics:
-                    statistics['errors'] = []
+            response = await browser_get(url, allow_redirects=True)
+        except httpx.HTTPError as e:
+            import traceback
 
-                statistics['errors'].append({
-                    'url': url,
-                    'type': type(e).__name__,
-                    'error': str(e),
-                    'traceback': traceback.format_exc()
-                })
-                continue
-
-            if not args.url:
-                links = crawler.get_links(response.url, response.text)
-                for link in links:
-                    crawler.add_to_queue(link)
+            # The URL was never actually visited: let another
+            # URL with the same template (e.g. the http variant
+            # of a failed https seed) be attempted
+            remove_from_visited(url)
 
-            crawler.add_to_visited(url)
-
-            if response.url != url:
-                url = response.url
-                crawler.add_to_visited(url)
+            log_error(f'ERROR: {url} -> {e}')
+            if not 'errors' in statistics:
+                statistics['errors'] = []
 
-            # Save all the request and response headers
-            network[url] = {
-                'request1': {
-                    'request': dict(response.request.headers),
-                    'response': {
-                        'status_code': response.status_code,
-                        'headers': dict(response.headers)
-                    }
+            statistics['errors'].append({
+                'url': url,
+                'type': type(e).__name__,
+                'error': str(e),
+                'traceback': traceback.format_exc()
+            })
+            return
+
+        if not args.url:
+            links = get_links(str(response.url), response.text)
+            for link in links:
+                add_to_queue(link)
+
+        # The URL itself was already marked as visited by the
+        # worker when it was dequeued; only the redirect target
+        # still needs to be marked
+        if str(response.url) != url:
+            url = str(response.url)
+            add_to_visited(url)
+
+        # Save all the request and response headers.
+        # Materialize each response's headers into plain
+        # dicts once and reuse them everywhere below.
+        r1_req  = dict(response.request.headers)
+        r1_resp = dict(response.headers)
+        r2_req  = r2_resp = None
+
+        # Only the entry for the URL being processed is kept in
+        # memory; it is appended to the NDJSON file when done
+        entry = {
+            'url': url,
+            'request1': {
+                'request': r1_req,
+                'response': {
+                    'status_code': response.status_code,
+                    'headers': r1_resp
                 }
             }
+        }
 
+        try:
             # Is the response coming from a cache or from the Origin? Is it cacheable?
-            cache_status = wcde.cache_headers_heuristics(response.headers)
+            cache_status = cache_headers_heuristics(r1_resp)
             if cache_status != '-':
                 statistics['cache_headers'] = True
 
             # If it's a HIT: we have our request
             if cache_status == 'HIT':
-                logger.info(f'The response gets cached -> cache_status = {cache_status}')
+                log_info('The response gets cached -> cache_status = %s', cache_status)
 
             # If it's a MISS: visit again and check if we get a HIT
             elif cache_status == 'MISS':
-                # Request again two times to try and cache the response
-                time.sleep(1)
-                response2 = browser.get(url)
-                time.sleep(2)
-                response2 = browser.get(url)
-
-                network[url]['request2'] = {
-                    'request': dict(response2.request.headers),
+                # Request again two times to try and cache the response.
+                # The sleeps only delay this URL: the other workers keep
+                # processing their own URLs in the meantime
+                await asyncio.sleep(1)
+                response2 = await browser_get(url)
+                await asyncio.sleep(2)
+                response2 = await browser_get(url)
+
+                r2_req  = dict(response2.request.headers)
+                r2_resp = dict(response2.headers)
+
+                entry['request2'] = {
+                    'request': r2_req,
                     'response': {
                         'status_code': response2.status_code,
-                        'headers': dict(response2.headers)
+                        'headers': r2_resp
                     }
                 }
 
-                cache_status2 = wcde.cache_headers_heuristics(response2.headers)
+                cache_status2 = cache_headers_heuristics(r2_resp)
                 if cache_status2 != '-':
                     statistics['cache_headers'] = True
 
                 if cache_status2 == 'HIT':
-                    logger.info(f'The response gets cached -> cache_status = {cache_status}/{cache_status2}')
+                    log_info('The response gets cached -> cache_status = %s/%s', cache_status, cache_status2)
                 else:
-                    logger.info(f'The response does not get cached -> cache_status = {cache_status}/{cache_status2}')
-                    continue
+                    log_info('The response does not get cached -> cache_status = %s/%s', cache_status, cache_status2)
+                    return
 
             # If it's something else: continue to the next URL
             else:
-                logger.info(f'The response does not get cached -> cache_status = {cache_status}')
-                continue
+                log_info('The response does not get cached -> cache_status = %s', cache_status)
+                return
 
             # If we are here, it means that the current URL gets cached
-            logger.info(f'Testing the Date header on {url}')
+            log_info('Testing the Date header on %s', url)
 
             statistics['URLs'][url] = {
                 'cache_status': cache_status if cache_status == 'HIT' else cache_status2,
@@ -320,96 +364,160 @@ def main():
             }
 
             # Check if there is a Date header
-            if 'response2' in network[url]:
-                network[url]['first'] = {
-                    'request': dict(response2.request.headers),
+            if r2_resp is not None:
+                entry['first'] = {
+                    'request': r2_req,
                     'response': {
                         'status_code': response2.status_code,
-                        'headers': dict(response2.headers)
+                        'headers': r2_resp
                     }
                 }
-                response_headers = response2.headers
+                response_headers = r2_resp
             else:
-                network[url]['first'] = {
-                    'request': dict(response.request.headers),
+                entry['first'] = {
+                    'request': r1_req,
                     'response': {
                         'status_code': response.status_code,
-                        'headers': dict(response.headers)
+                        'headers': r1_resp
                     }
                 }
-                response_headers = response.headers
+                response_headers = r1_resp
 
-            if 'Date' in response_headers:
+            date = response_headers.get('date')
+            if date is not None:
                 # Identify te cache
-                cache = cache_identification.identify(response_headers)
+                cache = identify(response_headers)
                 statistics['URLs'][url]['cache'] = cache
-                logger.info(f'Identified cache: {bcolors.OKGREEN}{", ".join(cache)}{bcolors.ENDC}')
+                log_info('Identified cache: %s%s%s', bcolors.OKGREEN, ', '.join(cache), bcolors.ENDC)
 
-                logger.info(f'Found Date header: {response_headers["Date"]}')
-                statistics['URLs'][url]['date'].append(response_headers['Date'])
+                log_info('Found Date header: %s', date)
+                statistics['URLs'][url]['date'].append(date)
 
                 # Check if it's changing
-                time.sleep(1.5)
-                response2 = browser.get(url)
-                network[url]['second'] = {
-                    'request': dict(response2.request.headers),
+                await asyncio.sleep(1.5)
+                response2 = await browser_get(url)
+                r2_req  = dict(response2.request.headers)
+                r2_resp = dict(response2.headers)
+                entry['second'] = {
+                    'request': r2_req,
                     'response': {
                         'status_code': response2.status_code,
-                        'headers': dict(response2.headers)
+                        'headers': r2_resp
                     }
                 }
 
-                if 'Date' in response2.headers:
-                    logger.info(f'Found Date header: {response2.headers["Date"]}')
-                    statistics['URLs'][url]['date'].append(response2.headers['Date'])
+                date2 = r2_resp.get('date')
+                if date2 is not None:
+                    log_info('Found Date header: %s', date2)
+                    statistics['URLs'][url]['date'].append(date2)
 
-                    if response.headers['Date'] != response2.headers['Date']:
-                        logger.info(f'The Date header is {bcolors.OKGREEN}changing{bcolors.ENDC}')
+                    if r1_resp.get('date') != date2:
+                        log_info('The Date header is %schanging%s', bcolors.OKGREEN, bcolors.ENDC)
                     else:
-                        logger.info(f'The Date header is {bcolors.WARNING}not changing{bcolors.ENDC}')
+                        log_info('The Date header is %snot changing%s', bcolors.WARNING, bcolors.ENDC)
 
                     # Cache bust and check if it's changing
-                    time.sleep(1.5)
-                    _url, _headers, _cookies = cache_buster.cache_bust_request(
+                    await asyncio.sleep(1.5)
+                    _url, _headers, _cookies = cache_bust_request(
                         url,
                         headers=headers,
                         cookies=cookies,
-                        vary=response_headers['Vary'] if 'Vary' in response_headers else '')
+                        vary=response_headers.get('vary', ''))
 
-                    response3 = browser.get(_url, headers=_headers, cookies=_cookies, allow_redirects=False)
-                    network[url]['third'] = {
-                        'request': dict(response3.request.headers),
+                    response3 = await browser_get(_url, headers=_headers, cookies=_cookies, allow_redirects=False)
+                    r3_req  = dict(response3.request.headers)
+                    r3_resp = dict(response3.headers)
+                    entry['third'] = {
+                        'request': r3_req,
                         'response': {
                             'status_code': response3.status_code,
-                            'headers': dict(response3.headers)
+                            'headers': r3_resp
                         }
                     }
 
-                    if 'Date' in response3.headers:
-                        logger.info(f'Found Date header: {response3.headers["Date"]}')
-                        statistics['URLs'][url]['date'].append(response3.headers['Date'])
+                    date3 = r3_resp.get('date')
+                    if date3 is not None:
+                        log_info('Found Date header: %s', date3)
+                        statistics['URLs'][url]['date'].append(date3)
 
-                        if response_headers['Date'] != response3.headers['Date']:
-                            logger.info(f'The Date header is {bcolors.OKGREEN}changing{bcolors.ENDC} after cache busting')
+                        if date != date3:
+                            log_info('The Date header is %schanging%s after cache busting', bcolors.OKGREEN, bcolors.ENDC)
                         else:
-                            logger.info(f'The Date header is {bcolors.WARNING}not changing{bcolors.ENDC} after cache busting')
+                            log_info('The Date header is %snot changing%s after cache busting', bcolors.WARNING, bcolors.ENDC)
 
-            break # TODO: remove this to test more than one URL
+            stop.set() # TODO: remove this to test more than one URL
+        finally:
+            # Stream the entry to disk even if the test
+            # failed halfway through
+            network_file.write(orjson.dumps(entry) + b'\n')
 
-        except KeyboardInterrupt:
-            break
-        except Exception as e:
-            logger.error(f'ERROR: {url} -> {e}')
-            logger.error(traceback.format_exc())
-            if not 'errors' in statistics:
-                statistics['errors'] = []
-            statistics['errors'].append({
-                'url': url,
-                'type': type(e).__name__,
-                'error': str(e),
-                'traceback': traceback.format_exc()
-            })
+    # Templates currently being tested by a worker. Shared
+    # with the crawler, which keeps further URLs with an
+    # in-flight template queued until the test resolves
+    in_flight = crawler.in_flight
+
+    async def worker():
+        nonlocal active
+
+        while not stop.is_set():
+            url = get_url_from_queue()
 
+            if url is None:
+                # Only give up when no worker is mid-fetch: the
+                # other workers may still enqueue links from the
+                # pages they are currently processing. With no
+                # active worker no new URLs can ever arrive
+                if active == 0:
+                    break
+                await asyncio.sleep(0.5)
+                continue
+
+            if exclude_re and exclude_re.search(url):
+                continue
+
+            parsed = urlparse(url)
+            if parsed.path.endswith(excluded_extensions):
+                continue
+
+            # Claim the URL before the (slow) fetch, so the other
+            # workers skip further URLs with the same template
+            # instead of testing them concurrently
+            template = get_template_url(url)
+            in_flight.add(template)
+            add_to_visited(url)
+
+            active += 1
+            try:
+                await test_url(url)
+            except Exception as e:
+                import traceback
+
+                log_error(f'ERROR: {url} -> {e}')
+                log_error(traceback.format_exc())
+                if not 'errors' in statistics:
+                    statistics['errors'] = []
+                statistics['errors'].append({
+                    'url': url,
+                    'type': type(e).__name__,
+                    'error': str(e),
+                    'traceback': traceback.format_exc()
+                })
+            finally:
+                in_flight.discard(template)
+                active -= 1
+
+    async def crawl():
+        try:
+            await asyncio.gather(*[worker() for _ in range(CONCURRENCY)])
+        finally:
+            await browser.close()
+
+    try:
+        asyncio.run(crawl())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        network_file.close()
 
     # Save dictionaries to files
     save_dictionaries(SITE, crawler)
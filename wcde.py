@@ -8,6 +8,7 @@ from urllib.parse import urlparse, urlunparse
 
 import random
 import string
+import re
 
 class WCDE:
     '''
@@ -39,6 +40,17 @@ class WCDE:
         self.LOGS   = 'logs'
         self.STATS  = 'stats'
 
+        # Precompiled alternations for cache_headers_heuristics:
+        # one C-level scan per header instead of a chain of 'in' checks
+        self._cache_name_re   = re.compile(
+            'x-drupal-cache|x-proxy-cache|x-rack-cache|cdn_cache|cf-cache|x-cache|x-edge')
+        self._hit_value_re    = re.compile('hit|expired|cached')
+        self._generic_name_re = re.compile('cache|server-timing')
+        self._ignore_name_re  = re.compile(
+            '|'.join(re.escape(header.lower()) for header in self.IGNORE_HEADERS))
+        self._generic_hit_re  = re.compile('hit|cached|edge|"fresh":false|max-age')
+        self._generic_miss_re = re.compile('miss|caching|origin|"fresh":true')
+
     def get_random_string(self, length):
         return ''.join(random.choice(string.ascii_letters) for i in range(length))
 
@@ -90,66 +102,45 @@ class WCDE:
         '-' if the status is unknown.
         '''
         cache_status = '-'
+        # Lowercase each header name and value once
+        items = [
+            (header.lower(), value, value.lower())
+            for header, value in headers.items()
+        ]
+
         # Start with the most specific headers for HIT
-        for header in headers:
-            if (
-                    'x-drupal-cache' in header.lower() or
-                    'x-proxy-cache' in header.lower() or
-                    'x-rack-cache' in header.lower() or
-                    'cdn_cache' in header.lower() or
-                    'cf-cache' in header.lower() or
-                    'x-cache' in header.lower() or
-                    'x-edge' in header.lower()):
-                if (
-                        'hit' in headers[header].lower() or
-                        'expired' in headers[header].lower() or
-                        'cached' in headers[header].lower()):
+        for header_l, value, value_l in items:
+            if self._cache_name_re.search(header_l):
+                if self._hit_value_re.search(value_l):
                     return 'HIT'
         # Then the most specific headers for MISS
-        for header in headers:
-            if (
-                    'x-drupal-cache' in header.lower() or
-                    'x-proxy-cache' in header.lower() or
-                    'x-rack-cache' in header.lower() or
-                    'cdn_cache' in header.lower() or
-                    'cf-cache' in header.lower() or
-                    'x-cache' in header.lower() or
-                    'x-edge' in header.lower()):
-                if 'miss' in headers[header].lower():
+        for header_l, value, value_l in items:
+            if self._cache_name_re.search(header_l):
+                if 'miss' in value_l:
                     return 'MISS'
                 else:
-                    cache_status = headers[header]
+                    cache_status = value
 
             # Then the extremely specific ones
-            if (header.lower() == 'x-rack-cache'):
-                if headers[header].lower() == 'fresh':
+            if (header_l == 'x-rack-cache'):
+                if value_l == 'fresh':
                     return 'HIT'
                 elif (
-                    headers[header].lower() == 'miss' or
-                    headers[header].lower() == 'pass' or
-                    headers[header].lower() == 'store'):
+                    value_l == 'miss' or
+                    value_l == 'pass' or
+                    value_l == 'store'):
                     return 'MISS'
 
             # Then the more generic ones
-            if (('cache' in header.lower() or
-                    'server-timing' in header.lower()) and
-                    not any(x.lower() in header.lower() for x in self.IGNORE_HEADERS)
+            if (self._generic_name_re.search(header_l) and
+                    not self._ignore_name_re.search(header_l)
                 ):
-                if (
-                    'hit' in headers[header].lower() or
-                    'cached' in headers[header].lower() or
-                    'edge' in headers[header].lower() or
-                    '"fresh":false' in headers[header].lower() or
-                    'max-age' in headers[header].lower()):
+                if self._generic_hit_re.search(value_l):
                     return 'HIT'
-                elif (
-                    'miss' in headers[header].lower() or
-                    'caching' in headers[header].lower() or
-                    'origin' in headers[header].lower() or
-                    '"fresh":true' in headers[header].lower()):
+                elif self._generic_miss_re.search(value_l):
                     return 'MISS'
                 elif cache_status == '-':
-                    cache_status = headers[header]
+                    cache_status = value
         return cache_status
 
     def identicality_checks(self, p1, p2):